@@ -6,6 +6,8 @@ import cgi
 import sys
 import time
 import html
+import fnmatch
+import weakref
 import threading
 import traceback
 from io import BytesIO, StringIO
@@ -141,11 +143,38 @@ class Root:
 
     period = 5
     maxhistory = 300
+    # The tree view switches from per-node gc.get_referrers() to a
+    # ReferrerIndex after this many lookups. A rough tunable: building
+    # the index costs somewhere around 50-150 gc.get_referrers() calls,
+    # depending on the heap.
+    referrer_index_after = 100
+    # The index takes about 250 bytes per gc-tracked object, so above this
+    # many (roughly 50 Mb) the tree view never builds it. 0 disables it.
+    referrer_index_limit = 200000
+    # Type groupings rolled up on the index page, see type_group().
+    # 'rules' is added by active_groupings() once group_rules is set.
+    groupings = ('module', 'base')
+    # Number of leading package components a 'module' group keeps.
+    group_depth = 1
+    # Classes the 'base' grouping groups under; if none of them is in the
+    # MRO of a type, it is grouped under the last class of its __base__
+    # chain below object.
+    group_bases = ()
+    # (glob pattern, group name) pairs matched against the type name
+    # by the 'rules' grouping; the first matching pattern wins.
+    group_rules = ()
 
     def __init__(self):
         self.running = False
         self.history = {}
+        self.grouphistory = defaultdict(dict)
+        # Group of each type, cached per type object: distinct classes may
+        # share a qualified name but not a group.
+        self.typegroups = defaultdict(weakref.WeakKeyDictionary)
+        # Names of the types ever seen in each group.
+        self.grouptypes = defaultdict(dict)
         self.typesizes = {}
+        self.groupsizes = {}
         self.samples = 0
 
     async def start(self, app):
@@ -177,6 +206,7 @@ class Root:
             aiohttp.web.get(r'/trace/{typename}/{objid}', self.trace, name='trace_objid'),
             aiohttp.web.get(r'/trace/{typename}', self.trace, name='trace'),
             aiohttp.web.get(r'/chart/{typename}', self.chart, name='chart'),
+            aiohttp.web.get(r'/groupchart/{grouping}', self.groupchart, name='groupchart'),
             aiohttp.web.get(r'/', self.index, name='index'),
         ])
 
@@ -192,27 +222,80 @@ class Root:
             objtype = type(obj)
             typecounts[objtype] += 1
 
+        groupcounts = {grouping: defaultdict(int) for grouping in self.active_groupings()}
         for objtype, count in typecounts.items():
             typename = objtype.__module__ + "." + objtype.__name__
             if typename not in self.history:
                 self.history[typename] = [0] * self.samples
             self.history[typename].append(count)
 
+            for grouping, counts in groupcounts.items():
+                typegroups = self.typegroups[grouping]
+                group = typegroups.get(objtype)
+                if group is None:
+                    group = typegroups[objtype] = self.type_group(grouping, objtype)
+                    self.grouptypes[grouping].setdefault(group, set()).add(typename)
+                counts[group] += count
+
+        for grouping, counts in groupcounts.items():
+            history = self.grouphistory[grouping]
+            for group, count in counts.items():
+                if group not in history:
+                    history[group] = [0] * self.samples
+                history[group].append(count)
+
         samples = self.samples + 1
+        histories = [self.history] + list(self.grouphistory.values())
 
         # Add dummy entries for any types which no longer exist
-        for typename, hist in self.history.items():
-            diff = samples - len(hist)
-            if diff > 0:
-                hist.extend([0] * diff)
+        for history in histories:
+            for typename, hist in history.items():
+                diff = samples - len(hist)
+                if diff > 0:
+                    hist.extend([0] * diff)
 
         # Truncate history to self.maxhistory
         if samples > self.maxhistory:
-            for typename, hist in self.history.items():
-                hist.pop(0)
+            for history in histories:
+                for typename, hist in history.items():
+                    hist.pop(0)
         else:
             self.samples = samples
 
+    def active_groupings(self):
+        """Return the groupings to compute and show."""
+        if self.group_rules and 'rules' not in self.groupings:
+            return self.groupings + ('rules',)
+        return self.groupings
+
+    def type_group(self, grouping, objtype):
+        """Return the name of the group objtype belongs to in the given grouping.
+
+        'module' groups types by the leading group_depth components of their
+        module, 'base' by a base class from their MRO and 'rules' by the
+        first matching pattern of group_rules.
+        """
+        if grouping == 'module':
+            return '.'.join(objtype.__module__.split('.')[:self.group_depth])
+        elif grouping == 'base':
+            for base in objtype.__mro__:
+                if base in self.group_bases:
+                    break
+            else:
+                # Follow the primary bases, so mixins do not decide the group.
+                base = objtype
+                while base.__base__ is not None and base.__base__ is not object:
+                    base = base.__base__
+            return base.__module__ + "." + base.__name__
+        elif grouping == 'rules':
+            typename = objtype.__module__ + "." + objtype.__name__
+            for pattern, group in self.group_rules:
+                if fnmatch.fnmatchcase(typename, pattern):
+                    return group
+            return 'other'
+        else:
+            raise ValueError(f"Unknown grouping {grouping!r}")
+
     async def stop(self, app):
         """Stop the execution."""
         self.running = False
@@ -228,12 +311,46 @@ class Root:
         return template("tracemalloc.html", output=io.getvalue())
 
     async def index(self, request):
-        """Main page."""
-        floor = int(request.query.get('floor', 0))
+        """Main page.
 
+        Starts with the types rolled up by the selected grouping; a group
+        is expanded to its types on demand. With no grouping every type
+        is listed.
+        """
+        floor = int(request.query.get('floor', 0))
+        groupings = [g for g in self.active_groupings() if g in self.grouphistory]
+        grouping = request.query.get('group', groupings[0] if groupings else '')
+        if grouping not in groupings:
+            grouping = ''
+        expand = request.query.get('expand')
+        if grouping and expand not in self.grouphistory[grouping]:
+            expand = None
+
+        if grouping and expand is None:
+            rows = self.group_rows(grouping, floor)
+        else:
+            if grouping:
+                typenames = list(self.grouptypes[grouping].get(expand, ()))
+                backurl = url("index").with_query(group=grouping, floor=floor)
+                rows = ['<p class="group"><a href="{backurl}">All groups</a> &raquo; {group}</p>'
+                        .format(backurl=html.escape(str(backurl)), group=html.escape(expand))]
+            else:
+                typenames = list(self.history.keys())
+                rows = []
+            rows.extend(self.type_rows(sorted(typenames), floor))
+
+        options = ['<option value=""{}>none</option>'.format('' if grouping else ' selected="selected"')]
+        for name in groupings:
+            options.append('<option value="{name}"{selected}>{name}</option>'
+                           .format(name=html.escape(name),
+                                   selected=' selected="selected"' if name == grouping else ''))
+        hidden = ('<input type="hidden" name="expand" value="{}" />'.format(html.escape(expand))
+                  if expand is not None else '')
+        return template("graphs.html", output="\n".join(rows), floor=int(floor),
+                        groupings="\n".join(options), expand=hidden)
+
+    def type_rows(self, typenames, floor):
         rows = []
-        typenames = list(self.history.keys())
-        typenames.sort()
         for typename in typenames:
             hist = self.history[typename]
             maxhist = max(hist)
@@ -250,7 +367,34 @@ class Root:
                                )
                        )
                 rows.append(row)
-        return template("graphs.html", output="\n".join(rows), floor=int(floor))
+        return rows
+
+    def group_rows(self, grouping, floor):
+        rows = []
+        history = self.grouphistory[grouping]
+        grouptypes = self.grouptypes[grouping]
+        for group in sorted(list(history.keys())):
+            hist = history[group]
+            # Only count the types which currently have instances.
+            types = sum(1 for typename in list(grouptypes.get(group, ()))
+                        if self.history[typename][-1])
+            maxhist = max(hist)
+            if maxhist > int(floor):
+                size = 'Size: <span class="objsize">{}</span>'.format(self.groupsizes.get(grouping, {}).get(group, unknown_size())) if pympler_available else ''
+                expandurl = url("index").with_query(group=grouping, expand=group, floor=floor)
+                row = ('<div class="typecount"><span class="typename"><a href="{expandurl}">{group}</a></span><br />'
+                       '<img class="chart" src="{charturl}" /><br />'
+                       'Min: <span class="minuse">{minuse}</span> Cur: <span class="curuse">{curuse}</span> Max: <span class="maxuse">{maxuse}</span> {size} Types: {types}</div>'
+                       .format(group=html.escape(group),
+                               expandurl=html.escape(str(expandurl)),
+                               charturl=html.escape(str(url("groupchart", grouping=grouping).with_query(group=group))),
+                               minuse=min(hist), curuse=hist[-1], maxuse=maxhist,
+                               types=types,
+                               size=size,
+                               )
+                       )
+                rows.append(row)
+        return rows
 
     async def calc_sizes(self, request):
         """Calucalte total sizes of all the typenames."""
@@ -261,21 +405,37 @@ class Root:
             _typesizes[type(obj)] += getsize(obj)
 
         typesizes = {}
+        _groupsizes = {grouping: defaultdict(int) for grouping in self.active_groupings()}
         for objtype, size in _typesizes.items():
             typename = objtype.__module__ + "." + objtype.__name__
             typesizes[typename] = format_size(size)
+            for grouping, sizes in _groupsizes.items():
+                # The cache is filled by tick() in its own thread; only read it here.
+                group = self.typegroups[grouping].get(objtype) or self.type_group(grouping, objtype)
+                sizes[group] += size
+
+        groupsizes = {grouping: {group: format_size(size) for group, size in sizes.items()}
+                      for grouping, sizes in _groupsizes.items()}
 
-        del _typesizes
+        del _typesizes, _groupsizes
         self.typesizes = typesizes
-        del typesizes
+        self.groupsizes = groupsizes
+        del typesizes, groupsizes
 
         return aiohttp.web.Response(text="Ok")
 
     async def chart(self, request):
         """Return a sparkline chart of the given type."""
         typename = request.match_info['typename']
+        return self.sparkline(self.history[typename])
+
+    async def groupchart(self, request):
+        """Return a sparkline chart of the given type group."""
+        grouping = request.match_info['grouping']
+        group = request.query['group']
+        return self.sparkline(self.grouphistory.get(grouping, {})[group])
 
-        data = self.history[typename]
+    def sparkline(self, data):
         height = 20.0
         scale = height / max(data)
         im = Image.new("RGB", (len(data), int(height)), 'white')
@@ -362,6 +522,12 @@ class Root:
             rows = ["<h3>The object you requested was not found.</h3>"]
         return rows
 
+    def tree_index_after(self, all_objs):
+        """Return index_after for a tree walk, or None if the heap is too large for an index."""
+        if not self.referrer_index_limit or len(all_objs) > self.referrer_index_limit:
+            return None
+        return self.referrer_index_after
+
     async def tree(self, request):
         typename = request.match_info['typename']
         objid = request.match_info['objid']
@@ -380,10 +546,13 @@ class Root:
                 else:
                     rows.append('<div class="obj">')
 
-                    tree = ReferrerTree(obj)
+                    tree = ReferrerTree(obj, all_objs, self.tree_index_after(all_objs))
                     tree.ignore(all_objs)
-                    for depth, parentid, parentrepr in tree.walk(maxresults=1000):
-                        rows.append(parentrepr)
+                    try:
+                        for depth, parentid, parentrepr in tree.walk(maxresults=1000):
+                            rows.append(parentrepr)
+                    finally:
+                        tree.clear_index()
 
                     rows.append('</div>')
                 break
@@ -408,7 +577,7 @@ class ReferrerTree(dowser.reftree.Tree):
         if isinstance(obj, ModuleType) and self.ignore_modules:
             return
 
-        refs = gc.get_referrers(obj)
+        refs = self.get_referrers(obj)
         refiter = iter(refs)
         self.ignore(refs, refiter)
         thisfile = sys._getframe().f_code.co_filename
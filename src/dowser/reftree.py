@@ -4,16 +4,83 @@ import sys
 from types import FrameType
 
 
+class ReferrerIndex:
+    """Reverse referent map built with a single pass over the gc heap.
+
+    gc.get_referrers() traverses every tracked object on each call, so
+    walking a tree of N referrers costs N heap scans. The index pays for
+    one scan up front and answers the lookups from a dict afterwards.
+
+    The map covers every object of the scanned snapshot, not only the
+    part a walk reaches. Objects outside the snapshot are not covered.
+    """
+
+    def __init__(self, objects=None):
+        if objects is None:
+            objects = gc.get_objects()
+        # Keep the snapshot alive so that scanned ids cannot be reused.
+        self.objects = objects
+        self.scanned = {id(obj) for obj in objects}
+
+        referrers = {}
+        for obj in objects:
+            # A container referring to the same object twice is still
+            # a single referrer, just like with gc.get_referrers().
+            children = {id(ref) for ref in gc.get_referents(obj)}
+            for refid in children:
+                if refid in self.scanned:
+                    referrers.setdefault(refid, []).append(obj)
+        self.referrers = referrers
+
+    def covers(self, obj):
+        """Return True if the referrers of obj were recorded."""
+        return id(obj) in self.scanned
+
+    def get_referrers(self, obj):
+        return list(self.referrers.get(id(obj), ()))
+
+    def clear(self):
+        self.referrers.clear()
+        self.scanned.clear()
+        self.objects = None
+
+
 class Tree:
-    def __init__(self, obj):
+    def __init__(self, obj, objects=None, index_after=None):
+        """If index_after is given, switch from gc.get_referrers() to a
+        ReferrerIndex over objects (or the whole heap) after that many lookups.
+        """
         self.obj = obj
         self.filename = sys._getframe().f_code.co_filename
         self._ignore = {}
+        self.objects = objects
+        self.index_after = index_after
+        self.index = None
+        self.lookups = 0
 
     def ignore(self, *objects):
         for obj in objects:
             self._ignore[id(obj)] = None
 
+    def get_referrers(self, obj):
+        """Return the referrers of obj, from the index when it has them."""
+        if self.index is None and self.index_after is not None and self.lookups >= self.index_after:
+            self.index = ReferrerIndex(self.objects)
+            self.ignore(self.index, self.index.__dict__, self.index.referrers,
+                        self.index.scanned, self.index.objects)
+        if self.index is not None and self.index.covers(obj):
+            return self.index.get_referrers(obj)
+        # Objects created after the snapshot are not in the index; index
+        # lists only hold snapshot objects, so they cannot refer to them.
+        self.lookups += 1
+        return gc.get_referrers(obj)
+
+    def clear_index(self):
+        """Release the referrer index, if one was built."""
+        if self.index is not None:
+            self.index.clear()
+            self.index = None
+
     def ignore_caller(self):
         f = sys._getframe()     # = this function
         cur = f.f_back          # = the function that called us (probably 'walk')
@@ -107,7 +174,7 @@ class ReferrerTree(Tree):
             yield depth, 0, "---- Max depth reached ----"
             return
 
-        refs = gc.get_referrers(obj)
+        refs = self.get_referrers(obj)
         refiter = iter(refs)
         self.ignore(refs, refiter)
         for ref in refiter: